@@ -2,38 +2,103 @@
 
 """Classes for S3 Buckets."""
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
+from botocore.config import Config
 from botocore.exceptions import ClientError
+import copy
+import hashlib
+import json
 import mimetypes
-from functools import reduce
+import mmap
+import os
 import boto3
-from hashlib import md5
 import util
 
+"""Public read policy, the Resource is filled with the bucket ARN."""
+POLICY_TEMPLATE = {
+    "Version": "2012-10-17",
+    "Statement": [{
+        "Sid": "PublicReadGetObject",
+        "Effect": "Allow",
+        "Principal": "*",
+        "Action": ["s3:GetObject"],
+        "Resource": [None]
+    }]
+}
+
+
+@lru_cache(maxsize=512)
+def content_type_for(ext):
+    """Get the content type for a file extension, i.e: '.html'.
+
+    It is cached since a site only has a handful of different extensions.
+    """
+    return mimetypes.guess_type('x' + ext)[0] or 'application/octet-stream'
+
+
 class BucketManager:
     """Manage an S3 Bucket."""
 
     """Class level constant"""
     CHUNK_SIZE = 8388608
+    SMALL_FILE_SIZE = 65536
+    INDEX_NAME = '.webotron-index.json'
+    MANIFEST_CACHE_DIR = os.path.join('~', '.webotron')
+
+    def __init__(self, session, max_concurrency=10, transfer_config=None):
+        """Create a BucketManager object.
+
+        max_concurrency is how many files sync will upload at the same time.
+        transfer_config overrides the TransferConfig used for each file, its
+        own max_concurrency is how many parts of one big file go up at the
+        same time, so sync can have up to
+        max_concurrency * transfer_config.max_concurrency requests in flight.
+        """
+        if max_concurrency < 1:
+            raise ValueError(
+                "max_concurrency must be at least 1, got {}".format(
+                    max_concurrency))
 
-    def __init__(self, session):
-        """Create a BucketManager object."""
         self.session = session
-        self.s3 = session.resource('s3')
-        self.transfer_config = boto3.s3.transfer.TransferConfig(
-            multipart_chunksize = self.CHUNK_SIZE,
-            multipart_threshold = self.CHUNK_SIZE
-        )
+        self.max_concurrency = max_concurrency
+        self.transfer_config = transfer_config or \
+            boto3.s3.transfer.TransferConfig(
+                multipart_chunksize=self.CHUNK_SIZE,
+                multipart_threshold=self.CHUNK_SIZE,
+                max_concurrency=max(10, (os.cpu_count() or 1) * 2),
+                use_threads=True,
+                io_chunksize=262144
+            )
+        """Every upload thread needs its own connection, or it waits for
+        one to be free, and big files use transfer_config.max_concurrency
+        connections each."""
+        botocore_config = Config(
+            max_pool_connections=max(
+                50,
+                max_concurrency * self.transfer_config.max_concurrency),
+            retries={'max_attempts': 5})
+        self.s3 = session.resource('s3', config=botocore_config)
+        """The low level client is thread safe and skips the resource
+        wrappers, so it's the one used on every hot path."""
+        self.client = session.client('s3', config=botocore_config)
         self.manifest = {}
+        self._region_cache = {}
 
 
     def get_region_name(self, bucket):
-        """Get the bucket's region name."""
-        client = self.s3.meta.client
-        bucket_location = client.get_bucket_location(
+        """Get the bucket's region name, it is only looked up once."""
+        if bucket.name in self._region_cache:
+            return self._region_cache[bucket.name]
+
+        bucket_location = self.client.get_bucket_location(
             Bucket=bucket.name)
 
-        return bucket_location["LocationConstraint"] or 'us-east-1'
+        region = bucket_location["LocationConstraint"] or 'us-east-1'
+        self._region_cache[bucket.name] = region
+        return region
 
     def get_bucket_url(self, bucket):
         """Get the URL for this bucket, also will be used to find out auto
@@ -55,15 +120,21 @@ class BucketManager:
 
     def init_bucket(self, bucket_name):
         """Create new bucket, or return existent one by name."""
+        """head_bucket is a cheap read, the bucket is only created when it
+        doesn't exist yet."""
+        try:
+            self.client.head_bucket(Bucket=bucket_name)
+            return self.s3.Bucket(bucket_name)
+        except ClientError as error:
+            if error.response['Error']['Code'] != '404':
+                raise error
+
         s3_bucket = None
         try:
             s3_bucket = self.s3.create_bucket(Bucket=bucket_name)
-
-
-
         except ClientError as error:
             if error.response['Error']['Code'] == 'BucketAlreadyOwnedByYou':
-                s3_bucket = s3.Bucket(bucket_name)
+                s3_bucket = self.s3.Bucket(bucket_name)
             else:
                 raise error
 
@@ -71,25 +142,12 @@ class BucketManager:
 
     def set_policy(self, bucket):
         """Set bucket policy to be readable for everyone."""
-        policy = """
-        {
-          "Version":"2012-10-17",
-          "Statement":[{
-          "Sid":"PublicReadGetObject",
-          "Effect":"Allow",
-          "Principal": "*",
-              "Action":["s3:GetObject"],
-              "Resource":["arn:aws:s3:::%s/*"
-              ]
-            }
-          ]
-        }
-        """ % bucket.name
-        """Strip removes the initial space on before the policy text."""
-        policy = policy.strip()
+        policy = copy.deepcopy(POLICY_TEMPLATE)
+        policy['Statement'][0]['Resource'][0] = \
+            "arn:aws:s3:::{}/*".format(bucket.name)
 
         pol = bucket.Policy()
-        pol.put(Policy=policy)
+        pol.put(Policy=json.dumps(policy, separators=(',', ':')))
 
     def configure_website(self, bucket):
         """Configure s3 website hosting for bucket, sets index.html as the
@@ -104,99 +162,327 @@ class BucketManager:
             }
         })
 
-    def load_manifest(self, bucket):
+    def load_manifest(self, bucket, prefix='', use_cache=False):
         """Load manifest for caching purposes. It helps to list all the
         files like a book making it easier to upload since will be using
         the ETag to compare if a file already exists in the S3. An obj will
         be a dictionay and will contain ETag, Key, LastModified, Size and
-        StorageClass"""
-        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket.name):
-            for obj in page.get('Contents', []):
-                self.manifest[obj['Key']] = obj['ETag']
-
-    @staticmethod
-    def hash_data(data):
-        """It will take some data in and then hash in md5 those."""
-        hash = md5()
-        hash.update(data)
-
-        return hash
-
-    def gen_etag(self, path):
-        """Generate etag for each file"""
-        hashes = []
-
-        """Will open and read the file as binary limiting it to the CHUNK_SIZE."""
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(self.CHUNK_SIZE)
-
-                if not data:
-                    break
-
-                hashes.append(self.hash_data(data))
-
-        if not hashes:
+        StorageClass, only (ETag, Size) is kept for each Key.
+        prefix limits the listing to the keys starting with it.
+        use_cache loads the manifest saved by the last sync instead of
+        listing the bucket again, see load_cached_manifest."""
+        if use_cache and self.load_cached_manifest(bucket, prefix):
             return
-        elif len(hashes) == 1:
+
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=bucket.name,
+            Prefix=prefix,
+            PaginationConfig={'PageSize': 1000})
+        for page in pages:
+            self.manifest.update({
+                obj['Key']: (obj['ETag'], obj['Size'])
+                for obj in page.get('Contents', ())})
+
+    def manifest_cache_path(self, bucket_name):
+        """Get the local file where the manifest of a bucket is saved."""
+        return os.path.join(
+            os.path.expanduser(self.MANIFEST_CACHE_DIR),
+            '{}.manifest.json'.format(bucket_name))
+
+    def load_cached_manifest(self, bucket, prefix=''):
+        """Load the manifest saved by a previous sync.
+
+        The bucket is not checked at all, the cached manifest is trusted as
+        is. Objects overwritten or deleted by something other than webotron
+        make sync skip files it should upload, that's why it's opt in.
+        Returns True when the cached manifest was used.
+        """
+        try:
+            with open(self.manifest_cache_path(bucket.name)) as f:
+                cached = json.load(f)
+
+            if cached['prefix'] != prefix:
+                return False
+
+            manifest = {key: tuple(value)
+                        for key, value in cached['manifest'].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+
+        self.manifest.update(manifest)
+        return True
+
+    def save_manifest(self, bucket, prefix=''):
+        """Save the manifest locally so the next sync can skip listing."""
+        path = self.manifest_cache_path(bucket.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        """Written to a temp file first so a crash never leaves a half
+        written manifest behind."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'prefix': prefix, 'manifest': self.manifest}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def gen_etag(cls, path, chunk_size=None, threshold=None, size=None):
+        """Generate etag for each file.
+
+        chunk_size and threshold have to be the multipart_chunksize and
+        multipart_threshold the file was uploaded with, or a multipart
+        ETag will never match. Both default to CHUNK_SIZE.
+        size saves a stat when the caller already knows it.
+        """
+        chunk = chunk_size or cls.CHUNK_SIZE
+        threshold = threshold or cls.CHUNK_SIZE
+        if size is None:
+            size = os.stat(path).st_size
+
+        if not size:
+            """S3 gives every empty object the md5 of no data as ETag."""
+            return '"{}"'.format(hashlib.md5().hexdigest())
+        elif size < threshold:
             """The double quotes here are bc the ETag comes with them automatically
             i.e: 'ETag': '"51568bc93ada05c778f47e6dc55ea085"'."""
-            """It should work fine for most of the cases but for big files it may
-            not be the best way to do it, bc it breaks the file in parts/chuncks."""
-            return '"{}"'.format(hashes[0].hexdigest())
+            """file_digest (Python 3.11+) hashes the whole file in C without
+            handing the data back to Python."""
+            with open(path, 'rb') as f:
+                if hasattr(hashlib, 'file_digest'):
+                    hash = hashlib.file_digest(f, 'md5')
+                else:
+                    hash = hashlib.md5(f.read())
+
+            return '"{}"'.format(hash.hexdigest())
         else:
             """AWS takes hash of each part of the data and then hashes it all
-            together.Reduce() will take another function in this case lambda()
-            and will take a list of things and then will iterate through it and
-            append each item to the previous one.
+            together, the file is mapped in memory so each part is hashed
+            straight from a memoryview slice without being copied.
             i.e: HASH_OF_HASHES(hash1+hash2+hash3...hashN)"""
-            hash = self.hash_data(reduce(lambda x, y: x + y, (h.digest() for h in hashes)))
+            parts = (size + chunk - 1) // chunk
+            """Each md5 digest is 16 bytes, they all go in one buffer."""
+            digests = bytearray(parts * 16)
+            with open(path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, \
+                    memoryview(m) as mv:
+                for i in range(parts):
+                    digests[i * 16:(i + 1) * 16] = hashlib.md5(
+                        mv[i * chunk:(i + 1) * chunk]).digest()
+
+            hash = hashlib.md5(digests)
 
             """First argument will return the hash of hashes and the second
             is the number of chuncks of our data."""
-            return '"{}-{}"'.format(hash.hexdigest(), len(hashes))
+            return '"{}-{}"'.format(hash.hexdigest(), parts)
+
+    def _etags_for(self, files):
+        """Generate the etags of all (path, size) files at once.
+
+        Hashing big files is CPU bound so those run in a process pool to get
+        around the GIL, small files are hashed right here since sending
+        them to another process costs more than hashing them. Returns a list
+        of etags in the same order as files.
+        """
+        chunk = self.transfer_config.multipart_chunksize
+        threshold = self.transfer_config.multipart_threshold
+        etags = {}
+        big = []
+        for path, size in files:
+            if size >= threshold:
+                big.append((path, size))
+            else:
+                etags[path] = self.gen_etag(path, chunk, threshold, size)
+
+        if big:
+            paths = [path for path, _ in big]
+            with ProcessPoolExecutor() as executor:
+                etags.update(zip(paths, executor.map(
+                    self.gen_etag, paths, repeat(chunk), repeat(threshold),
+                    [size for _, size in big])))
+
+        return [etags[path] for path, _ in files]
+
+    def same_size(self, key, size):
+        """Check if key is in the manifest with the same size.
 
+        A file that isn't in the bucket or whose size changed will never
+        match the ETag, so there is no point hashing it.
+        """
+        prev = self.manifest.get(key)
+        return prev is not None and prev[1] == size
 
     def upload_file(self, bucket, path, key):
         """Upload files to a bucket.
         bukcet is the S3 to receive the files
         path is where files will be updated to
         key is the name of the file."""
-        """mimetypes here will identify which kinda file we'll be updating to S3."""
-        content_type = mimetypes.guess_type(key)[0] or 'text/plain'
-
-        """Generating ETags for path."""
-        etag = self.gen_etag(path)
-
         """Will get the key from AWS and if it doesn't exist will create a new
-        one."""
-        if self.manifest.get(key, '') == etag:
+        one, the ETag is only generated when the sizes match."""
+        size = os.path.getsize(path)
+        if self.same_size(key, size) and \
+                self.gen_etag(
+                    path,
+                    self.transfer_config.multipart_chunksize,
+                    self.transfer_config.multipart_threshold,
+                    size) == \
+                self.manifest[key][0]:
             """print("Skipping {}, ETags match".format(key))"""
             return
 
-        return bucket.upload_file(
-            path,
-            key,
+        return self.put_file(bucket, path, key, size)
+
+    def put_file(self, bucket, path, key, size=None):
+        """Upload path to the bucket as key, without checking the manifest.
+
+        size saves a stat when the caller already knows it.
+        """
+        """mimetypes here will identify which kinda file we'll be updating to S3."""
+        content_type = content_type_for(os.path.splitext(key)[1].lower())
+
+        """Small files go up in a single put_object, skipping the transfer
+        manager which is only worth it for multipart uploads."""
+        if size is None:
+            size = os.path.getsize(path)
+
+        if size < self.SMALL_FILE_SIZE:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            return self.client.put_object(
+                Bucket=bucket.name,
+                Key=key,
+                Body=data,
+                ContentType=content_type)
+
+        return self.client.upload_file(
+            Filename=path,
+            Bucket=bucket.name,
+            Key=key,
             ExtraArgs={
                 'ContentType': content_type
             },
             Config=self.transfer_config)
 
-    def sync(self, pathname, bucket_name):
-        """Sync contents of a path to bucket."""
-        bucket = self.s3.Bucket(bucket_name)
-        self.load_manifest(bucket)
+    @staticmethod
+    def load_index(index_path):
+        """Load the local index of the last sync.
+
+        It maps each key to the (mtime_ns, size, etag) its file had then,
+        it's empty when there is no index yet or it isn't a dict.
+        """
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
 
-        root = Path(pathname).expanduser().resolve()
-        """Checks if the current structure is a folder or a file before
-        uploading to S3"""
-        def handle_directory(target):
-            for p in target.iterdir():
-                if p.is_dir():
-                    handle_directory(p)
-                if p.is_file():
-                    self.upload_file(bucket, str(p), str(p.relative_to(root)))
+        return index if isinstance(index, dict) else {}
 
+    @staticmethod
+    def save_index(index_path, index):
+        """Save the local index, a read only folder just doesn't get one."""
+        tmp_path = index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass
 
-        handle_directory(root)
+    @staticmethod
+    def walk(root):
+        """Yield (path, key) for every file under root.
+
+        key is the path relative to root, always with '/' separators.
+        Folders are kept on a stack instead of recursing, and symlinked
+        folders are not followed so a link back up the tree can't loop
+        forever. Symlinked files are synced like any other file.
+        """
+        root = os.fspath(root)
+        """Every path under root starts with it, so the key is just the
+        rest of the string."""
+        start = len(root.rstrip(os.sep)) + 1
+        stack = [root]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path, \
+                            entry.path[start:].replace(os.sep, '/')
+
+    def sync(self, pathname, bucket_name, prefix='', use_cache=False):
+        """Sync contents of a path to bucket.
+
+        prefix is put in front of every key, i.e: 'blog/', and only that
+        part of the bucket is listed for the manifest. A '/' is added to
+        the end of it when missing, so 'blog' doesn't also match 'blog2/'.
+        use_cache reuses the manifest saved locally by the last sync and
+        saves the updated one at the end.
+        """
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+
+        bucket = self.s3.Bucket(bucket_name)
+        self.load_manifest(bucket, prefix, use_cache)
+
+        root = os.fspath(Path(pathname).expanduser().resolve())
+        index_path = os.path.join(root, self.INDEX_NAME)
+        """Builds the (path, key) pairs first so the uploads can run in
+        parallel, each upload is mostly waiting on the network."""
+        pairs = [(path, prefix + key) for path, key in self.walk(root)
+                 if not path.startswith(index_path)]
+        stats = [os.stat(path) for path, _ in pairs]
+        sizes = {key: stat.st_size for (_, key), stat in zip(pairs, stats)}
+
+        """A file with the same mtime and size as in the index of the last
+        sync still has the etag recorded then, it doesn't need hashing. The
+        index is keyed by the path relative to root, without the prefix, so
+        syncing the same folder under another prefix still uses it."""
+        index = self.load_index(index_path)
+        etags = {}
+        for (path, key), stat in zip(pairs, stats):
+            """Anything but a [mtime_ns, size, etag] entry is a miss and the
+            file gets hashed."""
+            entry = index.get(key[len(prefix):])
+            if isinstance(entry, (list, tuple)) and len(entry) == 3 and \
+                    entry[0] == stat.st_mtime_ns and \
+                    entry[1] == stat.st_size:
+                etags[key] = entry[2]
+
+        """All the other etags are generated before the uploads start, only
+        the files whose etag doesn't match the manifest are uploaded. Files
+        that are new or changed size are uploaded without being hashed."""
+        candidates = [(path, key) for path, key in pairs
+                      if key not in etags and self.same_size(key, sizes[key])]
+        etags.update(zip(
+            [key for _, key in candidates],
+            self._etags_for(
+                [(path, sizes[key]) for path, key in candidates])))
+        changed = [(path, key) for path, key in pairs
+                   if key not in self.manifest or key not in etags or
+                   self.manifest[key][0] != etags[key]]
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            list(executor.map(
+                lambda pair: self.put_file(
+                    bucket, pair[0], pair[1], sizes[pair[1]]),
+                changed))
+
+        if use_cache:
+            """New files were never hashed, their etags are needed for the
+            saved manifest to match next time."""
+            unknown = [(path, key) for path, key in changed
+                       if key not in etags]
+            etags.update(zip(
+                [key for _, key in unknown],
+                self._etags_for(
+                [(path, sizes[key]) for path, key in unknown])))
+            self.manifest.update({
+                key: (etags[key], sizes[key]) for _, key in changed})
+            self.save_manifest(bucket, prefix)
+
+        self.save_index(index_path, {
+            key[len(prefix):]: (stat.st_mtime_ns, stat.st_size, etags[key])
+            for (path, key), stat in zip(pairs, stats) if key in etags})
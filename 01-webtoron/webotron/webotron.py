@@ -25,7 +25,10 @@ bucket_manager = None
 @click.group()
 @click.option('--profile', default=None,
               help="Use a given AWS profile")
-def cli(profile):
+@click.option('--concurrency', default=10, show_default=True,
+              type=click.IntRange(min=1),
+              help="How many files sync uploads at the same time")
+def cli(profile, concurrency):
     """Webotron deploys websites to AWS."""
 
     """Makes these variables global."""
@@ -39,7 +42,7 @@ def cli(profile):
     """***session_cfg will decouple the dictionary and make it easy to pass
     as a param."""
     session = boto3.Session(**session_cfg)
-    bucket_manager = BucketManager(session)
+    bucket_manager = BucketManager(session, max_concurrency=concurrency)
 
 
 @cli.command('list-buckets')
@@ -74,9 +77,15 @@ def setup_bucket(bucket):
 @cli.command('sync')
 @click.argument('pathname', type=click.Path(exists=True))
 @click.argument('bucket')
-def sync(pathname, bucket):
+@click.option('--prefix', default='',
+              help="Upload under this key prefix, i.e: blog/")
+@click.option('--cache-manifest', is_flag=True,
+              help="Reuse the bucket listing saved by the last sync without "
+                   "checking BUCKET, only safe when webotron is the only "
+                   "thing writing to it")
+def sync(pathname, bucket, prefix, cache_manifest):
     """Sync contents of PATHNAME to BUCKET."""
-    bucket_manager.sync(pathname, bucket)
+    bucket_manager.sync(pathname, bucket, prefix, cache_manifest)
     print(bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket)))
 
 